@@ -6,6 +6,7 @@ import io
 import re
 import unicodedata
 from datetime import datetime, date
+from functools import lru_cache
 from pathlib import Path
 
 import pandas as pd
@@ -14,6 +15,26 @@ import streamlit as st
 # NOVO: imports para mapa térmico
 import requests
 import plotly.express as px
+import plotly.io as pio
+
+# orjson (C) é bem mais rápido para o GeoJSON de vários MB; opcional
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    import json
+    _json_loads = json.loads
+
+# xlsxwriter grava o Excel mais rápido e com menos memória que o openpyxl; opcional.
+# strings_to_urls=False: mantém o Google_Maps como texto (como no openpyxl); senão cada
+# linha vira hyperlink e, acima do limite de 65.530 por aba, as células saem vazias
+try:
+    import xlsxwriter  # noqa: F401
+    _EXCEL_ENGINE = "xlsxwriter"
+    _EXCEL_ENGINE_KWARGS = {"options": {"strings_to_urls": False}}
+except ImportError:
+    _EXCEL_ENGINE = "openpyxl"
+    _EXCEL_ENGINE_KWARGS = {}
 
 # -------------------------------------------------------------
 # Configuração do app
@@ -30,42 +51,51 @@ st.caption("By Raphael + Copilot — Streamlit")
 # -------------------------------------------------------------
 # Funções utilitárias
 # -------------------------------------------------------------
-def strip_all(s):
-    if pd.isna(s):
-        return s
-    return str(s).replace("\n", " ").replace("\r", " ").strip()
-
-def normalize_spaces(s):
-    if pd.isna(s):
-        return s
-    # remove duplos espaços e espaços antes de pontuação
-    s = re.sub(r"\s+", " ", str(s))
-    s = re.sub(r"\s+([,.])", r"\1", s)
-    return s.strip()
-
-def normalize_text(s):
-    if pd.isna(s):
+# Texto em buffers Arrow: menos memória e kernels nativos para .str (pyarrow já vem com o streamlit)
+STRING_DTYPE = "string[pyarrow]"
+# Em strings Arrow as regex rodam no RE2, onde \s é só [\t\n\f\r ]: lista os demais
+# caracteres que o \s do Python aceita (\v das quebras do Word, NBSP, espaços Unicode)
+_WS = "[\\s\x0b\x1c-\x1f\x85\xa0\u1680\u2000-\u200a\u2028\u2029\u202f\u205f\u3000]"
+
+@lru_cache(maxsize=4096)
+def _strip_accents_cached(s: str) -> str:
+    # ASCII puro não tem acentos: evita a decomposição NFD
+    if s.isascii():
         return s
-    return normalize_spaces(strip_all(s))
+    return ''.join(c for c in unicodedata.normalize('NFD', s) if unicodedata.category(c) != 'Mn')
 
 def strip_accents(s: str) -> str:
     if s is None:
         return s
-    s = str(s)
-    return ''.join(c for c in unicodedata.normalize('NFD', s) if unicodedata.category(c) != 'Mn')
+    return _strip_accents_cached(str(s))
+
+def map_unique(s: pd.Series, func) -> pd.Series:
+    """Aplica func uma vez por valor distinto (colunas com poucos valores, ex.: cidades)."""
+    codes, uniques = pd.factorize(s)
+    # nulos recebem código -1 => último item (func(None))
+    mapped = pd.Series([func(u) for u in uniques] + [func(None)], dtype=object)
+    return pd.Series(mapped.to_numpy()[codes], index=s.index)
+
+# Regex do BO compiladas uma única vez
+_BO_STRIP = re.compile(r"[^0-9/\-]")
+_BO_FULL = re.compile(r"\d{3}-\d{5}/\d{4}")
+_BO_DIGITS = re.compile(r"\d+")
+# últimos três grupos de dígitos (equivale a findall(...)[-3:])
+_BO_GROUPS = re.compile(r"(\d+)\D+(\d+)\D+(\d+)\D*$")
 
 def normalize_bo(bo):
     """Padroniza BO no formato NNN-NNNNN/AAAA a partir de entradas variadas."""
-    if pd.isna(bo) or str(bo).strip() == "":
+    # teste de nulo direto (None, NaN, pd.NA): evita o dispatch de pd.isna
+    if bo is None or bo is pd.NA or (isinstance(bo, float) and bo != bo) or str(bo).strip() == "":
         return None
     s = str(bo)
     # mantém somente dígitos e separadores principais
-    s = re.sub(r"[^0-9/\-]", "", s)
+    s = _BO_STRIP.sub("", s)
     # já está no padrão correto
-    if re.fullmatch(r"\d{3}-\d{5}/\d{4}", s):
+    if _BO_FULL.fullmatch(s):
         return s
     # captura grupos de números (primeiros 3, próximos 5 e últimos 4)
-    digits = re.findall(r"\d+", s)
+    digits = _BO_DIGITS.findall(s)
     if len(digits) >= 3:
         a, b, c = digits[-3], digits[-2], digits[-1]
         a = a.zfill(3)[-3:]
@@ -74,42 +104,74 @@ def normalize_bo(bo):
         return f"{a}-{b}/{c}"
     return s if s else None
 
-def try_parse_date_any(dval):
-    """Aceita datas em dd/mm/yyyy, mm/dd/yyyy, yyyy-mm-dd e variações."""
-    if dval is None or (isinstance(dval, float) and pd.isna(dval)):
-        return None
-    # já é Timestamp/date
-    if isinstance(dval, (pd.Timestamp, datetime)):
-        return pd.to_datetime(dval).date()
-    if isinstance(dval, date):
-        return dval
-    s = str(dval).strip()
-    # Tenta formatos explícitos
-    for fmt in ("%d/%m/%Y", "%d-%m-%Y", "%m/%d/%Y", "%Y-%m-%d"):
-        try:
-            return datetime.strptime(s, fmt).date()
-        except Exception:
-            pass
-    # Pandas parse (tenta com dayfirst True e False)
-    for dayfirst in (True, False):
-        try:
-            ts = pd.to_datetime(s, dayfirst=dayfirst, errors="coerce")
-            if not pd.isna(ts):
-                return ts.date()
-        except Exception:
-            pass
-    return None
+def normalize_bo_series(bo: pd.Series) -> pd.Series:
+    """Versão vetorizada de normalize_bo para a coluna inteira."""
+    s = bo.astype(STRING_DTYPE).str.replace(_BO_STRIP.pattern, "", regex=True)
+    g = s.str.extract(_BO_GROUPS.pattern)
+    full = (
+        g[0].str.zfill(3).str[-3:] + "-" +
+        g[1].str.zfill(5).str[-5:] + "/" +
+        g[2].str.zfill(4).str[-4:]
+    )
+    # sem três grupos: mantém o que sobrou (vazio vira nulo)
+    return full.fillna(s.replace("", pd.NA))
+
+# Formatos tentados em ordem; cada etapa só olha o que as anteriores não resolveram
+_DATE_STAGES = (
+    {"format": "ISO8601"},                       # yyyy-mm-dd (exato, nunca dia primeiro)
+    {"format": "%d/%m/%Y"},
+    {"format": "%d-%m-%Y"},
+    {"format": "%m/%d/%Y"},
+    {"format": "mixed", "dayfirst": True},       # demais variações
+    {"format": "mixed", "dayfirst": False},
+)
+
+def parse_dates_series(dval: pd.Series) -> pd.Series:
+    """Aceita datas em dd/mm/yyyy, mm/dd/yyyy, yyyy-mm-dd e variações (coluna inteira)."""
+    if pd.api.types.is_datetime64_any_dtype(dval):
+        parsed = dval
+    else:
+        # só texto e datas: números (ex.: serial do Excel) seriam lidos como epoch
+        obj = dval.astype(object)
+        is_dt = obj.map(lambda v: isinstance(v, (datetime, date)))
+        is_str = obj.map(lambda v: isinstance(v, str))
+        text = obj[is_str].str.strip()
+        parsed_str = pd.to_datetime(text, errors="coerce", **_DATE_STAGES[0])
+        for stage in _DATE_STAGES[1:]:
+            pending = parsed_str.isna() & (text != "")
+            if not pending.any():
+                break
+            parsed_str = parsed_str.combine_first(
+                pd.to_datetime(text[pending], errors="coerce", **stage)
+            )
+        parsed = pd.concat([pd.to_datetime(obj[is_dt]), parsed_str]).reindex(dval.index)
+    # objetos date (ou None), como o restante do app espera
+    return parsed.dt.date.astype(object).where(parsed.notna(), None)
+
+MAPS_SEARCH_URL = "https://www.google.com/maps/search/?api=1&query="
 
 def google_maps_link(endereco, bairro=None, cidade=None):
     parts = [str(endereco)]
     if bairro: parts.append(str(bairro))
     if cidade: parts.append(str(cidade))
     q = ", ".join([p for p in parts if p and str(p).strip()])
-    return f"https://www.google.com/maps/search/?api=1&query={q.replace(' ', '+')}"
+    return MAPS_SEARCH_URL + q.replace(' ', '+')
+
+def google_maps_link_series(endereco: pd.Series, bairro: pd.Series, cidade: pd.Series) -> pd.Series:
+    """Versão vetorizada de google_maps_link (uma coluna de links)."""
+    q = (
+        endereco.astype(STRING_DTYPE)
+                .str.cat([bairro.astype(STRING_DTYPE), cidade.astype(STRING_DTYPE)], sep=", ", na_rep="")
+                .str.replace(f"(?:,{_WS}*){{2,}}", ", ", regex=True)  # partes vazias
+                .str.strip(", ")
+                .str.replace(" ", "+", regex=False)
+    )
+    return MAPS_SEARCH_URL + q
 
 def df_to_excel_bytes(df, filename="export.xlsx"):
     out = io.BytesIO()
-    with pd.ExcelWriter(out, engine="openpyxl") as writer:
+    # Sem constant_memory: o pandas escreve coluna a coluna e esse modo só aceita linha a linha.
+    with pd.ExcelWriter(out, engine=_EXCEL_ENGINE, engine_kwargs=_EXCEL_ENGINE_KWARGS) as writer:
         df.to_excel(writer, index=False, sheet_name="Filtrado")
     out.seek(0)
     return out.getvalue()
@@ -120,10 +182,15 @@ def kpi_card(label, value, help_text=None):
         st.caption(help_text)
 
 # ------------- GEOJSON / Choropleth helpers (NOVO) -------------
-@st.cache_data(show_spinner=True)
+# Malhas locais opcionais (ex.: geo/geojs-33-mun.json, simplificadas com mapshaper)
+GEO_DIR = Path(__file__).parent / "geo"
+
+# cache_resource: o GeoJSON é só leitura, evita copiar o dict a cada rerun
+@st.cache_resource(show_spinner=True)
 def load_geojson_municipios(uf_code: str, allow_insecure: bool = False):
     """
     Carrega GeoJSON de municípios da UF (ex.: RJ='33', ES='32') com múltiplos fallbacks:
+      0) arquivo local em GEO_DIR, se existir (sem rede)
       1) jsDelivr (CDN do GitHub)
       2) GitHub Raw
       3) API de Malhas IBGE (estado, resolucao=5 => inclui municípios)
@@ -142,19 +209,23 @@ def load_geojson_municipios(uf_code: str, allow_insecure: bool = False):
         "qualidade": "2"  # 1..4 (quanto maior, mais detalhado e pesado)
     }
 
+    local_path = GEO_DIR / f"geojs-{uf_code}-mun.json"
+    if local_path.is_file():
+        return _json_loads(local_path.read_bytes())
+
     # Tentativas seguras (SSL verificado)
     for url in (cdn_url, gh_url):
         try:
             r = requests.get(url, timeout=30)
             r.raise_for_status()
-            return r.json()
+            return _json_loads(r.content)
         except Exception:
             pass  # tenta próximo
 
     try:
         r = requests.get(ibge_url, params=ibge_params, timeout=30)
         r.raise_for_status()
-        return r.json()
+        return _json_loads(r.content)
     except Exception:
         pass
 
@@ -165,24 +236,19 @@ def load_geojson_municipios(uf_code: str, allow_insecure: bool = False):
                 r = requests.get(url, timeout=30, verify=False)
                 r.raise_for_status()
                 st.warning("⚠️ SSL desativado para baixar o GeoJSON (use apenas para teste).")
-                return r.json()
+                return _json_loads(r.content)
             except Exception:
                 pass
         try:
             r = requests.get(ibge_url, params=ibge_params, timeout=30, verify=False)
             r.raise_for_status()
             st.warning("⚠️ SSL desativado para baixar o GeoJSON (use apenas para teste).")
-            return r.json()
+            return _json_loads(r.content)
         except Exception:
             pass
 
     raise RuntimeError("Não foi possível carregar o GeoJSON de municípios desta UF pelas fontes disponíveis.")
 
-def norm_city_name(s: str) -> str:
-    if s is None or (isinstance(s, float) and pd.isna(s)):
-        return ""
-    return strip_accents(str(s)).upper().strip()
-
 # Correções de nomes comuns observados (ajuste aqui quando aparecerem novas divergências)
 CITY_FIX = {
     "SAO JOAO DE MERIT": "SAO JOAO DE MERITI",
@@ -190,9 +256,20 @@ CITY_FIX = {
     "RIO DE JANEIRO-": "RIO DE JANEIRO",
 }
 
-def apply_city_fix(s: str) -> str:
-    base = norm_city_name(s)
-    return CITY_FIX.get(base, base)
+def norm_city_series(s: pd.Series) -> pd.Series:
+    """Nome de cidade sem acentos, maiúsculo e sem espaços nas pontas (nulo vira "").
+    NFKD + descarte de não-ASCII remove os acentos (e NBSP vira espaço comum)."""
+    return (
+        s.astype(STRING_DTYPE).fillna("")
+         .str.normalize("NFKD")
+         .str.encode("ascii", "ignore")
+         .str.decode("ascii")
+         .str.upper()
+         .str.strip()
+    )
+
+def apply_city_fix_series(s: pd.Series) -> pd.Series:
+    return norm_city_series(s).replace(CITY_FIX)
 
 # -------------------------------------------------------------
 # Upload de arquivo
@@ -218,11 +295,20 @@ if not file:
     st.stop()
 
 # Leitura do arquivo
+def _open_excel(_file):
+    """Abre a planilha com o leitor calamine (Rust, bem mais rápido); cai no engine padrão se indisponível."""
+    try:
+        return pd.ExcelFile(_file, engine="calamine")
+    except (ImportError, ValueError):
+        # python-calamine não instalado ou pandas < 2.2
+        _file.seek(0)
+        return pd.ExcelFile(_file)
+
 @st.cache_data(show_spinner=True)
 def load_dataframe(_file, sheet_hint=None):
     fname = _file.name.lower()
     if fname.endswith((".xlsx", ".xls")):
-        xls = pd.ExcelFile(_file)
+        xls = _open_excel(_file)
         # tenta usar a sheet_hint se existir
         sheet_to_use = None
         if sheet_hint and sheet_hint in xls.sheet_names:
@@ -236,7 +322,7 @@ def load_dataframe(_file, sheet_hint=None):
             if sheet_to_use is None:
                 # usa primeira aba
                 sheet_to_use = xls.sheet_names[0]
-        df = pd.read_excel(xls, sheet_name=sheet_to_use, engine="openpyxl")
+        df = pd.read_excel(xls, sheet_name=sheet_to_use)
         return df, sheet_to_use
     elif fname.endswith(".csv"):
         df = pd.read_csv(_file, sep=None, engine="python")
@@ -279,64 +365,107 @@ def _map_cols(df_in: pd.DataFrame) -> dict:
         elif "projeto" in cl: cmap[col] = "Projeto_Publico"
     return cmap
 
-colmap = _map_cols(df_raw)
-df = df_raw.rename(columns=colmap).copy()
-missing = [c for c in expected_cols if c not in df.columns]
-if missing:
-    st.warning(
-        "Algumas colunas obrigatórias não foram encontradas: " + ", ".join(missing) +
-        "\n\nVou tentar continuar com o que existir, mas certos recursos podem ficar limitados."
-    )
-
-# garante todas as colunas esperadas (criando vazias se não existirem)
-for c in expected_cols:
-    if c not in df.columns:
-        df[c] = None
-
 # -------------------------------------------------------------
-# Limpeza e enriquecimento
+# Limpeza e enriquecimento (cacheado: o Streamlit reexecuta o script a cada interação)
 # -------------------------------------------------------------
 text_cols = [
     "Tipo_Cliente", "Nome_Cliente", "Endereco", "Bairro", "Cidade",
     "Tipo_Impedimento", "Projeto_Publico", "BO_Numero"
 ]
-for c in text_cols:
-    df[c] = df[c].apply(normalize_text)
-
-# Datas
-df["Data_Parsed"] = df["Data"].apply(try_parse_date_any)
-
-# BO normalizado
-df["BO_Numero_Normalizado"] = df["BO_Numero"].apply(normalize_bo)
-
-# Projeto Público normalizado (SIM/NÃO)
-pp = df["Projeto_Publico"].fillna("").astype(str).str.upper()
-pp = pp.apply(lambda x: strip_accents(x))
-pp = pp.replace({
-    "SIM": "SIM",
-    "NAO": "NÃO",
-    "NAO ": "NÃO",
-    "N/A": "NÃO",
-    "": None
-})
-df["Projeto_Publico"] = pp
-
-# Link Google Maps
-df["Google_Maps"] = df.apply(
-    lambda r: google_maps_link(r.get("Endereco"), r.get("Bairro"), r.get("Cidade")), axis=1
-)
+cat_cols = ["Tipo_Cliente", "Bairro", "Cidade", "Tipo_Impedimento", "Projeto_Publico"]
+
+@st.cache_data(show_spinner=False)
+def enrich(df_raw: pd.DataFrame):
+    """Mapeia colunas, limpa textos e calcula colunas derivadas. Retorna (df, colunas ausentes)."""
+    colmap = _map_cols(df_raw)
+    df = df_raw.rename(columns=colmap).copy()
+    missing = [c for c in expected_cols if c not in df.columns]
+
+    # garante todas as colunas esperadas (criando vazias se não existirem)
+    for c in expected_cols:
+        if c not in df.columns:
+            df[c] = None
+
+    for c in text_cols:
+        # vetorizado: quebras de linha, duplos espaços e espaços antes de pontuação
+        df[c] = (
+            df[c].astype(STRING_DTYPE)
+                 .str.replace("\r", " ", regex=False)
+                 .str.replace("\n", " ", regex=False)
+                 .str.replace(_WS + "+", " ", regex=True)
+                 .str.replace(_WS + r"+([,.])", r"\1", regex=True)
+                 .str.strip()
+        )
+
+    # Datas
+    df["Data_Parsed"] = parse_dates_series(df["Data"])
+
+    # BO normalizado
+    df["BO_Numero_Normalizado"] = normalize_bo_series(df["BO_Numero"])
+
+    # Projeto Público normalizado (SIM/NÃO)
+    pp = df["Projeto_Publico"].fillna("").astype(str).str.upper()
+    pp = map_unique(pp, strip_accents)
+    pp = pp.replace({
+        "SIM": "SIM",
+        "NAO": "NÃO",
+        "NAO ": "NÃO",
+        "N/A": "NÃO",
+        "": None
+    })
+    df["Projeto_Publico"] = pp
+
+    # Link Google Maps
+    df["Google_Maps"] = google_maps_link_series(df["Endereco"], df["Bairro"], df["Cidade"])
+
+    # Duplicidades
+    df["Duplicado_ID"] = df["ID_Chamado"].duplicated(keep=False)
+    # trata BO nulo como não duplicado
+    bo = df["BO_Numero_Normalizado"]
+    df["Duplicado_BO"] = bo.duplicated(keep=False) & bo.notna()
+
+    # Texto da busca rápida (ID, BO, Nome, Endereço) já em minúsculas;
+    # separado por quebra de linha para não casar entre campos
+    df["_search_blob"] = (
+        df["ID_Chamado"].astype(str).astype(STRING_DTYPE)
+          .str.cat(
+              [df[c].astype(STRING_DTYPE) for c in
+               ["BO_Numero", "BO_Numero_Normalizado", "Nome_Cliente", "Endereco"]],
+              sep="\n", na_rep=""
+          )
+          .str.lower()
+    )
 
-# Duplicidades
-df["Duplicado_ID"] = df["ID_Chamado"].astype(str).duplicated(keep=False)
-# trata BO nulo como não duplicado
-bo_tmp = df["BO_Numero_Normalizado"].fillna("__NA__").astype(str)
-df["Duplicado_BO"] = bo_tmp.duplicated(keep=False) & (bo_tmp != "__NA__")
+    # Colunas de filtro com poucos valores distintos: categóricas
+    for c in cat_cols:
+        df[c] = df[c].astype("category")
+    return df, missing
+
+df, missing = enrich(df_raw)
+if missing:
+    st.warning(
+        "Algumas colunas obrigatórias não foram encontradas: " + ", ".join(missing) +
+        "\n\nVou tentar continuar com o que existir, mas certos recursos podem ficar limitados."
+    )
+
+# IDs existentes para validar o formulário; recalculado só quando muda o arquivo/aba
+_id_key = (file.name, file.size, used_sheet)
+if st.session_state.get("_id_set_key") != _id_key:
+    st.session_state["_id_set"] = set(df["ID_Chamado"].dropna().astype(str).str.strip())
+    st.session_state["_id_set_key"] = _id_key
 
 # -------------------------------------------------------------
 # Filtros
 # -------------------------------------------------------------
 st.subheader("🔎 Filtros")
 
+def filter_options(df_in: pd.DataFrame) -> dict:
+    # astype("category") já gera as categorias ordenadas e sem nulos: nada a ordenar por rerun
+    return {c: ["(Todos)"] + df_in[c].cat.categories.tolist()
+            for c in ["Tipo_Cliente", "Bairro", "Cidade", "Tipo_Impedimento"]}
+
+opts = filter_options(df)
+
 col1, col2, col3, col4 = st.columns(4)
 with col1:
     min_date = df["Data_Parsed"].min()
@@ -346,51 +475,45 @@ with col1:
         value=(min_date, max_date) if (min_date and max_date) else None
     )
 with col2:
-    tipos = ["(Todos)"] + sorted([x for x in df["Tipo_Cliente"].dropna().unique()])
-    tipo_sel = st.selectbox("Tipo de Cliente", tipos)
+    tipo_sel = st.selectbox("Tipo de Cliente", opts["Tipo_Cliente"])
 with col3:
-    bairros = ["(Todos)"] + sorted([x for x in df["Bairro"].dropna().unique()])
-    bairro_sel = st.selectbox("Bairro", bairros)
+    bairro_sel = st.selectbox("Bairro", opts["Bairro"])
 with col4:
-    cidades = ["(Todos)"] + sorted([x for x in df["Cidade"].dropna().unique()])
-    cidade_sel = st.selectbox("Cidade", cidades)
+    cidade_sel = st.selectbox("Cidade", opts["Cidade"])
 
 col5, col6, col7 = st.columns(3)
 with col5:
-    impedimentos = ["(Todos)"] + sorted([x for x in df["Tipo_Impedimento"].dropna().unique()])
-    imp_sel = st.selectbox("Tipo de Impedimento", impedimentos)
+    imp_sel = st.selectbox("Tipo de Impedimento", opts["Tipo_Impedimento"])
 with col6:
     proj_opts = ["(Todos)", "SIM", "NÃO"]
     proj_sel = st.selectbox("Projeto Público", proj_opts)
 with col7:
     quick_search = st.text_input("Busca rápida (ID, BO, Nome, Endereço)", value="").strip()
 
-# aplica filtros
-fdf = df.copy()
+# aplica filtros: uma única máscara booleana, um único recorte no final
+mask = pd.Series(True, index=df.index)
 if isinstance(date_range, tuple) and len(date_range) == 2 and all(date_range):
     d0, d1 = date_range
-    fdf = fdf[(fdf["Data_Parsed"] >= d0) & (fdf["Data_Parsed"] <= d1)]
+    mask &= df["Data_Parsed"].between(d0, d1)
 if tipo_sel != "(Todos)":
-    fdf = fdf[fdf["Tipo_Cliente"] == tipo_sel]
+    mask &= df["Tipo_Cliente"] == tipo_sel
 if bairro_sel != "(Todos)":
-    fdf = fdf[fdf["Bairro"] == bairro_sel]
+    mask &= df["Bairro"] == bairro_sel
 if cidade_sel != "(Todos)":
-    fdf = fdf[fdf["Cidade"] == cidade_sel]
+    mask &= df["Cidade"] == cidade_sel
 if imp_sel != "(Todos)":
-    fdf = fdf[fdf["Tipo_Impedimento"] == imp_sel]
+    mask &= df["Tipo_Impedimento"] == imp_sel
 if proj_sel != "(Todos)":
-    fdf = fdf[fdf["Projeto_Publico"].fillna("NÃO") == proj_sel]
+    # nulo conta como NÃO (fillna não serve: "NÃO" pode não ser categoria)
+    pp_null = df["Projeto_Publico"].isna() & (proj_sel == "NÃO")
+    mask &= (df["Projeto_Publico"] == proj_sel) | pp_null
 
 if quick_search:
     qs = quick_search.lower()
-    mask = (
-        fdf["ID_Chamado"].astype(str).str.contains(qs, case=False, na=False) |
-        fdf["BO_Numero"].astype(str).str.contains(qs, case=False, na=False) |
-        fdf["BO_Numero_Normalizado"].astype(str).str.contains(qs, case=False, na=False) |
-        fdf["Nome_Cliente"].astype(str).str.lower().str.contains(qs, na=False) |
-        fdf["Endereco"].astype(str).str.lower().str.contains(qs, na=False)
-    )
-    fdf = fdf[mask]
+    # uma única busca literal sobre o texto pré-calculado em enrich()
+    mask &= df["_search_blob"].str.contains(qs, regex=False, na=False)
+
+fdf = df.loc[mask]
 
 # -------------------------------------------------------------
 # KPIs (sem gráficos, apenas métricas)
@@ -401,9 +524,10 @@ with c1:
     kpi_card("Total de R.O no filtro", f"{len(fdf):,}".replace(",", "."))
 with c2:
     top_imp = fdf["Tipo_Impedimento"].value_counts().head(1)
+    top_imp = top_imp[top_imp > 0]  # categorias sem registros no filtro
     kpi_card("Impedimento mais comum", f"{top_imp.index[0]} ({int(top_imp.iloc[0])})" if not top_imp.empty else "-")
 with c3:
-    sim = (fdf["Projeto_Publico"].fillna("NÃO") == "SIM").sum()
+    sim = (fdf["Projeto_Publico"] == "SIM").sum()
     kpi_card("Projeto Público (SIM)", f"{sim}")
 with c4:
     uniques_bo = fdf["BO_Numero_Normalizado"].nunique()
@@ -424,20 +548,27 @@ cols_show = [
 # garante colunas presentes
 cols_show = [c for c in cols_show if c in fdf.columns]
 
-# Destaque de duplicidade (Styler)
-from pandas.io.formats.style import Styler
+# Destaque de duplicidade (Styler) só em tabelas pequenas: o Styler serializa
+# CSS por célula e fica muito lento; acima do limite mostramos apenas a contagem
+STYLER_MAX_ROWS = 500
+
 def highlight_dups_col(series):
     return ['background-color: #ffd6d6' if bool(v) else '' for v in series]
 
-styled = fdf[cols_show].style
-if "Duplicado_ID" in fdf.columns:
-    styled = styled.apply(highlight_dups_col, subset=["Duplicado_ID"])  # type: ignore
-if "Duplicado_BO" in fdf.columns:
-    styled = styled.apply(highlight_dups_col, subset=["Duplicado_BO"])  # type: ignore
+table = fdf[cols_show]
+if len(fdf) < STYLER_MAX_ROWS:
+    table = table.style
+    if "Duplicado_ID" in fdf.columns:
+        table = table.apply(highlight_dups_col, subset=["Duplicado_ID"])  # type: ignore
+    if "Duplicado_BO" in fdf.columns:
+        table = table.apply(highlight_dups_col, subset=["Duplicado_BO"])  # type: ignore
+else:
+    n_dups = int((fdf["Duplicado_ID"] | fdf["Duplicado_BO"]).sum())
+    st.caption(f"⚠️ {n_dups} registro(s) com ID ou BO duplicado — ordene pelas colunas Duplicado_ID / Duplicado_BO.")
 
 # Renderiza com coluna de link como botão
 st.dataframe(
-    styled,
+    table,
     use_container_width=True,
     height=480,
     column_config={
@@ -462,13 +593,8 @@ with col_map_1:
 with col_map_2:
     st.caption("Cada município é colorido pela quantidade de R.O no *filtro atual*. Use os filtros acima para mudar o mapa.")
 
-# Agregado por cidade (normalizado) do filtro atual
-city_counts = (
-    fdf.assign(Cidade_norm=fdf["Cidade"].apply(apply_city_fix))
-       .groupby("Cidade_norm")
-       .size()
-       .reset_index(name="Qtde")
-)
+# Agregado por cidade (normalizado) do filtro atual: {Cidade_norm: Qtde}
+city_counts = apply_city_fix_series(fdf["Cidade"]).value_counts().to_dict()
 
 # Carrega GeoJSON da UF escolhida (com fallbacks)
 gj = None
@@ -478,27 +604,30 @@ try:
 except Exception as e:
     st.error(f"Falha ao carregar GeoJSON da UF {uf_escolhida}: {e}")
 
-if gj:
-    # Extrai (id, nome) do geojson
-    features = gj.get("features", [])
-    muni_df = pd.DataFrame([{
-        "id": (ft.get("id") or ft.get("properties", {}).get("id") or ft.get("properties", {}).get("code")),
-        "NM_MUN": (ft.get("properties", {}).get("name") or
-                   ft.get("properties", {}).get("NM_MUNICIPIO") or
-                   ft.get("properties", {}).get("name_muni"))
-    } for ft in features])
-
-    # Normaliza nome p/ join
-    muni_df["Cidade_norm"] = muni_df["NM_MUN"].apply(norm_city_name)
+# Figura cacheada por (UF, contagens): reruns sem mudança de filtro não refazem o mapa.
+# Cada entrada embute o GeoJSON inteiro da UF (vários MB): limita a quantidade guardada.
+@st.cache_data(show_spinner=False, max_entries=16)
+def build_choropleth(uf_code: str, counts: dict):
+    """Monta o choropleth da UF. Retorna (figura em JSON, cidades que não casaram com a malha)."""
+    gj = load_geojson_municipios(uf_code)
+    city_counts = pd.DataFrame({"Cidade_norm": list(counts.keys()), "Qtde": list(counts.values())})
+
+    # Extrai (id, nome) do geojson em listas paralelas
+    ids, names = [], []
+    for ft in gj.get("features", []):
+        props = ft.get("properties") or {}
+        ids.append(ft.get("id") or props.get("id") or props.get("code"))
+        names.append(props.get("name") or props.get("NM_MUNICIPIO") or props.get("name_muni"))
+    muni_df = pd.DataFrame({"id": ids, "NM_MUN": names})
+
+    # Normaliza nome p/ join (mesma regra de apply_city_fix_series)
+    muni_df["Cidade_norm"] = norm_city_series(muni_df["NM_MUN"])
 
     # Join: municípios da malha X contagem do filtro
     joined = muni_df.merge(city_counts, on="Cidade_norm", how="left").fillna({"Qtde": 0})
 
     # Diagnóstico de cidades não casadas
     nao_casaram = sorted(set(city_counts["Cidade_norm"]) - set(muni_df["Cidade_norm"]))
-    if nao_casaram:
-        with st.expander("⚠️ Cidades do filtro que não casaram com a malha (adicione no CITY_FIX se necessário)"):
-            st.write(nao_casaram)
 
     # Choropleth
     max_q = int(joined["Qtde"].max()) if not joined.empty else 1
@@ -523,7 +652,14 @@ if gj:
         margin=dict(l=0, r=0, t=10, b=0),
         coloraxis_colorbar=dict(title="R.O", thickness=12, len=0.7)
     )
-    st.plotly_chart(fig, use_container_width=True)
+    return fig.to_json(), nao_casaram
+
+if gj:
+    fig_json, nao_casaram = build_choropleth(uf_code, city_counts)
+    if nao_casaram:
+        with st.expander("⚠️ Cidades do filtro que não casaram com a malha (adicione no CITY_FIX se necessário)"):
+            st.write(nao_casaram)
+    st.plotly_chart(pio.from_json(fig_json), use_container_width=True)
 else:
     st.info("Mapa indisponível no momento. Tente novamente.")
 
@@ -614,7 +750,7 @@ if enable_form:
                 if not str(v).strip():
                     errors.append(f"Campo obrigatório: {k}")
 
-            if str(new_id).strip() in df["ID_Chamado"].astype(str).tolist():
+            if str(new_id).strip() in st.session_state["_id_set"]:
                 errors.append("ID_Chamado já existe na planilha.")
 
             if errors:
@@ -638,14 +774,18 @@ if enable_form:
                     "Duplicado_ID": False,
                     "Duplicado_BO": False,
                 }
-                st.session_state.setdefault("new_rows", [])
-                st.session_state["new_rows"].append(new_row)
+                # DataFrame mantido na sessão: concatena só no envio, não a cada rerun
+                row_df = pd.DataFrame([new_row])
+                if "new_rows_df" in st.session_state:
+                    row_df = pd.concat([st.session_state["new_rows_df"], row_df], ignore_index=True)
+                st.session_state["new_rows_df"] = row_df
+                st.session_state["_id_set"].add(str(new_id).strip())
                 st.success("Registro adicionado na sessão. Para persistir, exporte o Excel filtrado e substitua sua planilha.")
 
     # Exibe adicionados na sessão
-    if "new_rows" in st.session_state and st.session_state["new_rows"]:
+    if "new_rows_df" in st.session_state:
         st.info("Registros adicionados nesta sessão (não alteram o arquivo original). Exporte para salvar.")
-        st.dataframe(pd.DataFrame(st.session_state["new_rows"]), use_container_width=True)
+        st.dataframe(st.session_state["new_rows_df"], use_container_width=True)
 
 # -------------------------------------------------------------
 # Qualidade dos dados